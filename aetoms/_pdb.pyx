@@ -0,0 +1,131 @@
+# cython: language_level=3
+"""
+Compiled formatter for the protein databank atomic structure format.
+
+This extension module is optional.  If it has not been built,
+`aetoms.models.pdb()` falls back to its pure Python implementation,
+which produces identical output.
+
+"""
+
+cimport cython
+from libc.stdio cimport snprintf
+from libc.stdlib cimport malloc, realloc, free
+
+import numpy as np
+
+__author__ = "Alexander Urban"
+__email__ = "aurban@atomistic.net"
+__date__ = "2021-01-23"
+__version__ = "0.1"
+
+
+cdef const char* HEADER = (b"CRYST1 %8.3f %8.3f %8.3f "
+                           b"%6.2f %6.2f %6.2f P 1\nMODEL     %d\n")
+cdef const char* ATOM = (b"ATOM %6d   %-2s MOL     1     %7.3f %7.3f %7.3f "
+                         b" 0.00  0.00          %-2s\n")
+cdef const char* FOOTER = b"ENDMOL\n"
+
+# Expected number of bytes per ATOM record; the buffer grows if a record
+# turns out to be longer (e.g., for very large coordinates).
+cdef Py_ssize_t LINE_SIZE = 96
+cdef Py_ssize_t HEADER_SIZE = 256
+
+
+cdef int _grow(char** buf, Py_ssize_t* size, Py_ssize_t needed) nogil:
+    """
+    Enlarge the buffer `buf` to hold at least `needed` bytes.  Returns
+    -1 if the memory could not be allocated and 0 otherwise.
+
+    """
+    cdef Py_ssize_t new_size = max(2*size[0], needed)
+    cdef char* new_buf = <char*>realloc(buf[0], new_size)
+    if new_buf == NULL:
+        return -1
+    buf[0] = new_buf
+    size[0] = new_size
+    return 0
+
+
+ctypedef fused real_t:
+    float
+    double
+
+
+def pdb_c(coords, types, double a, double b, double c,
+          double alpha, double beta, double gamma, int model=1):
+    """
+    Return string in the protein databank atomic structure format.
+
+    Arguments:
+      coords[i, j] (float): j-th Cartesian coordinate of the i-th atom
+      types[i] (str): chemical symbol of atom i
+      a, b, c (float): lenghts of the three lattice vectors
+      alpha, beta, gamma (float): cell angles in degrees
+      model (int): model number for multi-model files
+
+    """
+    cdef const float[:, ::1] xyz_f4
+    cdef const double[:, ::1] xyz_f8
+    coords = np.asarray(coords)
+    if coords.dtype == np.float32:
+        xyz_f4 = np.ascontiguousarray(coords).reshape((-1, 3))
+        return _pdb(xyz_f4, types, a, b, c, alpha, beta, gamma, model)
+    xyz_f8 = np.ascontiguousarray(coords, dtype=np.float64).reshape((-1, 3))
+    return _pdb(xyz_f8, types, a, b, c, alpha, beta, gamma, model)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef str _pdb(const real_t[:, ::1] xyz, types, double a, double b, double c,
+              double alpha, double beta, double gamma, int model):
+    cdef Py_ssize_t n = xyz.shape[0]
+    cdef list symbols = [t.encode("ascii") for t in types]
+    if len(symbols) != n:
+        raise ValueError("Number of atom types does not match the number "
+                         "of atomic coordinates.")
+
+    # pointers into the bytes objects in `symbols`, so that the
+    # formatting loop does not need to touch any Python objects
+    cdef const char** sym = <const char**>malloc((n + 1)*sizeof(char*))
+    cdef Py_ssize_t size = n*LINE_SIZE + HEADER_SIZE
+    cdef char* buf = <char*>malloc(size)
+    cdef Py_ssize_t i, off = 0
+    cdef int m
+    cdef bint failed = False
+    if sym == NULL or buf == NULL:
+        free(sym)
+        free(buf)
+        raise MemoryError()
+    for i in range(n):
+        sym[i] = symbols[i]
+
+    try:
+        with nogil:
+            m = snprintf(buf, size, HEADER, a, b, c,
+                         alpha, beta, gamma, model)
+            if m >= size:
+                failed = _grow(&buf, &size, m + n*LINE_SIZE + 1) < 0
+                if not failed:
+                    m = snprintf(buf, size, HEADER, a, b, c,
+                                 alpha, beta, gamma, model)
+            off = m
+            i = 0
+            while i < n and not failed:
+                m = snprintf(buf + off, size - off, ATOM, <int>i, sym[i],
+                             xyz[i, 0], xyz[i, 1], xyz[i, 2], sym[i])
+                if m >= size - off:
+                    failed = _grow(&buf, &size, off + m + 1) < 0
+                    continue
+                off += m
+                i += 1
+            if not failed and size - off <= 8:
+                failed = _grow(&buf, &size, off + 8) < 0
+            if not failed:
+                off += snprintf(buf + off, size - off, FOOTER)
+        if failed:
+            raise MemoryError()
+        return buf[:off].decode("ascii")
+    finally:
+        free(sym)
+        free(buf)
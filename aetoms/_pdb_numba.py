@@ -0,0 +1,135 @@
+"""
+Numba-compiled formatter for the ATOM records of the protein databank
+format.
+
+This module is optional and can only be imported if Numba is installed.
+It is used by `aetoms.models.pdb()` if `aetoms.models.use_numba` is set
+and the Cython extension has not been built.
+
+"""
+
+import math
+
+import numba
+import numpy as np
+
+__author__ = "Alexander Urban"
+__email__ = "aurban@atomistic.net"
+__date__ = "2021-01-23"
+__version__ = "0.1"
+
+
+# Template of an ATOM record with blanks for the fields that are filled
+# in by the kernel.  The offsets are the first character of each field.
+_TEMPLATE = np.frombuffer(
+    ("ATOM " + 6*" " + "   " + 2*" " + " MOL     1     "
+     + 7*" " + " " + 7*" " + " " + 7*" "
+     + "  0.00  0.00          " + 2*" " + "\n").encode("ascii"),
+    dtype=np.uint8)
+_LINE_SIZE = _TEMPLATE.shape[0]
+_INDEX = 5
+_SYMBOL = 14
+_COORDS = (31, 39, 47)
+_ELEMENT = 76
+
+# Ranges that fit into the fixed-width fields (%6d and %7.3f); other
+# input is left to the pure Python implementation.
+_MAX_ATOMS = 1000000
+_MAX_COORD = 999.999
+_MIN_COORD = -99.999
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _write_int(buf, end, value):
+    """
+    Write the decimal digits of the non-negative integer `value` into
+    `buf` such that the last digit is at position `end`.  Returns the
+    position before the first digit.
+
+    """
+    buf[end] = 48 + value % 10
+    value //= 10
+    end -= 1
+    while value > 0:
+        buf[end] = 48 + value % 10
+        value //= 10
+        end -= 1
+    return end
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _write_fixed3(buf, start, x):
+    """
+    Write `x` with three decimals right-aligned into the seven characters
+    starting at `start`, rounding like printf's %7.3f.
+
+    """
+    neg = x < 0.0 or (x == 0.0 and math.copysign(1.0, x) < 0.0)
+    a = abs(x)
+    p = a*1000.0
+    # Dekker's error-free product: a*1000 = p + e exactly.  The error is
+    # needed to resolve values that appear to be halfway between two
+    # results after the multiplication.
+    c = 134217729.0*a
+    a_hi = c - (c - a)
+    a_lo = a - a_hi
+    e = (a_hi*1000.0 - p) + a_lo*1000.0
+    q = math.floor(p)
+    f = p - q
+    if f > 0.5 or (f == 0.5 and (e > 0.0 or (e == 0.0 and q % 2 == 1))):
+        q += 1.0
+    value = np.int64(q)
+    pos = start + 6
+    for k in range(3):
+        buf[pos] = 48 + value % 10
+        value //= 10
+        pos -= 1
+    buf[pos] = 46  # '.'
+    pos = _write_int(buf, pos - 1, value)
+    if neg:
+        buf[pos] = 45  # '-'
+
+
+@numba.njit(parallel=True, cache=True, boundscheck=False)
+def _format_atoms(coords, symbols, out):
+    for i in numba.prange(coords.shape[0]):
+        off = i*_LINE_SIZE
+        out[off:off + _LINE_SIZE] = _TEMPLATE
+        _write_int(out, off + _INDEX + 5, i)
+        out[off + _SYMBOL] = symbols[i, 0]
+        out[off + _SYMBOL + 1] = symbols[i, 1]
+        out[off + _ELEMENT] = symbols[i, 0]
+        out[off + _ELEMENT + 1] = symbols[i, 1]
+        for j in range(3):
+            _write_fixed3(out, off + _COORDS[j], coords[i, j])
+
+
+def format_atoms(coords, types):
+    """
+    Return the ATOM records of an atomic structure.
+
+    Arguments:
+      coords[i, j] (float): j-th Cartesian coordinate of the i-th atom
+      types[i] (str): chemical symbol of atom i
+
+    Returns:
+      The ATOM records as a single string, or None if the structure does
+      not fit into the fixed-width fields of the records.
+
+    """
+    coords = np.ascontiguousarray(coords, dtype=np.float64).reshape((-1, 3))
+    n = coords.shape[0]
+    if n != len(types) or n > _MAX_ATOMS:
+        return None
+    if not np.all((coords < _MAX_COORD) & (coords > _MIN_COORD)):
+        return None
+    if any(len(t) > 2 for t in types):
+        return None
+    try:
+        symbols = "".join(t.ljust(2) for t in types).encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    symbols = np.frombuffer(symbols, dtype=np.uint8).reshape((n, 2))
+    out = np.empty(n*_LINE_SIZE, dtype=np.uint8)
+    _format_atoms(coords, symbols, out)
+    return out.tobytes().decode("ascii")
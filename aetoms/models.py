@@ -3,6 +3,13 @@ Atomic structure models.
 
 """
 
+import copy
+import functools
+import os
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
 try:
     import ase
     import ase.io
@@ -10,6 +17,11 @@ try:
 except ImportError:
     ase_loaded = False
 
+try:
+    from ._pdb import pdb_c
+except ImportError:
+    pdb_c = None
+
 from .styles import (BallAndStickStyle, StickStyle, VanDerWaalsStyle,
                      UnitCellStyle)
 
@@ -20,7 +32,13 @@ __date__ = "2021-01-23"
 __version__ = "0.1"
 
 
-atom_styles = {
+# Set to True to format the ATOM records with the optional Numba kernel
+# if the compiled extension has not been built.  Importing and compiling
+# the kernel takes a few seconds, which only pays off for very large
+# structures and trajectories.
+use_numba = False
+
+atom_styles = MappingProxyType({
     'bs': BallAndStickStyle(),
     'ballsticks': BallAndStickStyle(),
     's': StickStyle(),
@@ -28,7 +46,44 @@ atom_styles = {
     'vdw': VanDerWaalsStyle(),
     'vanderwaals': VanDerWaalsStyle(),
     'default': BallAndStickStyle()
-}
+})
+
+
+@functools.lru_cache(maxsize=256)
+def _cryst1(a, b, c, alpha, beta, gamma):
+    """
+    Return the CRYST1 record with the cell parameters.  The record is
+    cached, since the cell is often the same for all frames of a
+    trajectory.
+
+    """
+    return ("CRYST1 %8.3f %8.3f %8.3f %6.2f %6.2f %6.2f P 1\n"
+            % (a, b, c, alpha, beta, gamma))
+
+
+@functools.lru_cache(maxsize=None)
+def _numba_format_atoms():
+    """
+    Return the Numba formatter of the ATOM records, or None if Numba is
+    not installed.  The kernel is only imported on first use.
+
+    """
+    try:
+        from ._pdb_numba import format_atoms
+    except ImportError:
+        return None
+    return format_atoms
+
+
+@functools.lru_cache(maxsize=None)
+def _validate_frmt(frmt):
+    """
+    Raise a ValueError if `frmt` is not a file format known to ASE.  Only
+    valid formats are cached, since the check raises for invalid ones.
+
+    """
+    if frmt not in ase.io.formats.ioformats:
+        raise ValueError("File format not supported: {}".format(frmt))
 
 
 def pdb(coords, types, a, b, c, alpha, beta, gamma, model=1):
@@ -43,69 +98,197 @@ def pdb(coords, types, a, b, c, alpha, beta, gamma, model=1):
       model (int): model number for multi-model files
 
     """
-    header = ("CRYST1 {:8.3f} {:8.3f} {:8.3f} "
-              "{:6.2f} {:6.2f} {:6.2f} P 1\nMODEL     {:d}\n")
-    atom = ("ATOM {0:6d}   {1:2s} MOL     1     {2:7.3f} {3:7.3f} {4:7.3f} "
-            "{5:5.2f}  0.00          {1:2s}\n")
-    out = ""
-    out += header.format(a, b, c, alpha, beta, gamma, model)
-    for i, coo in enumerate(coords):
-        out += atom.format(i, types[i], coo[0], coo[1], coo[2], 0.0)
-    out += "ENDMOL\n"
-    return out
+    if len(types) != len(coords):
+        raise ValueError("Number of atom types does not match the number "
+                         "of atomic coordinates.")
+    if pdb_c is not None:
+        return pdb_c(coords, types, a, b, c, alpha, beta, gamma, model)
+    parts = [_cryst1(a, b, c, alpha, beta, gamma),
+             "MODEL     %d\n" % model]
+    atoms = None
+    if use_numba:
+        format_atoms = _numba_format_atoms()
+        if format_atoms is not None:
+            atoms = format_atoms(coords, types)
+    if atoms is not None:
+        parts.append(atoms)
+    else:
+        atom = ("ATOM %6d   %-2s MOL     1     %7.3f %7.3f %7.3f "
+                " 0.00  0.00          %-2s\n")
+        # Convert NumPy arrays to nested lists in a single call, which is
+        # much faster than accessing the array elements one at a time.
+        if hasattr(coords, "tolist"):
+            coords = coords.tolist()
+        parts.extend(atom % (i, t, x, y, z, t)
+                     for i, (t, (x, y, z)) in enumerate(zip(types, coords)))
+    parts.append("ENDMOL\n")
+    return "".join(parts)
+
+
+def _pdb_worker(payload):
+    """
+    Return the PDB string for one frame.
+
+    Arguments:
+      payload (tuple): frame index and raw frame (see `_LazyFrames`)
+
+    """
+    i, raw_frame = payload
+    return pdb(*raw_frame, model=(i+1))
+
+
+class _LazyFrames(Sequence):
+    """
+    Sequence of PDB frames that are generated only when accessed.
+
+    Arguments:
+      raw_frames (list): one tuple (coords, types, a, b, c, alpha, beta,
+        gamma) per frame with the arguments of `pdb()`
+      maxsize (int): number of generated frames that are kept in memory
+
+    Iterating over all frames generates them in parallel threads if the
+    compiled formatter is available and the frames contain more than
+    `parallel_min_atoms` atoms in total.
+
+    """
+
+    parallel_min_atoms = 100000
+
+    def __init__(self, raw_frames, maxsize=64):
+        self._raw_frames = raw_frames
+        self._maxsize = maxsize
+        self._frame = functools.lru_cache(maxsize=maxsize)(self._make_frame)
+
+    def __getstate__(self):
+        # the LRU cache cannot be pickled and is recreated instead
+        return (self._raw_frames, self._maxsize)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _make_frame(self, i):
+        return _pdb_worker((i, self._raw_frames[i]))
+
+    def __iter__(self):
+        n = len(self)
+        # Only the compiled formatter releases the GIL.  The Python
+        # formatter would not run faster in threads, and a process pool
+        # is not used since forking is unsafe once the Numba kernel has
+        # started its threads.
+        if pdb_c is None or n < 2:
+            return (self[i] for i in range(n))
+        num_atoms = sum(len(raw[1]) for raw in self._raw_frames)
+        if num_atoms < self.parallel_min_atoms:
+            return (self[i] for i in range(n))
+        chunksize = max(1, n//(4*(os.cpu_count() or 1)))
+        with ThreadPoolExecutor() as ex:
+            frames = list(ex.map(_pdb_worker, enumerate(self._raw_frames),
+                                 chunksize=chunksize))
+        return iter(frames)
+
+    def __len__(self):
+        return len(self._raw_frames)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Frame index out of range.")
+        return self._frame(i)
 
 
 class Model(object):
 
-    def __init__(self, frames, show_cell=True, style='default'):
+    __slots__ = ('_frames', '_joined', '_payload_version', '_loaded_payload',
+                 '_active_frame', '_dirty', 'representations', '_apply_ops',
+                 'frmt', 'show_cell', 'cell_style', 'model_id', '_view',
+                 '_model')
+
+    def __init__(self, frames, show_cell=True, style='default',
+                 cell_style=None):
+        self.representations = []
+        self._apply_ops = []
+        self._payload_version = 0
+        self._loaded_payload = None
         self.frames = frames
         self._active_frame = -1
-        self.representations = []
+        self._dirty = True
         self.add_representation(style=style)
         self.frmt = "pdb"
         self.show_cell = show_cell
-        self.cell_style = UnitCellStyle()
+        if cell_style is not None:
+            self.cell_style = cell_style
+        else:
+            self.cell_style = UnitCellStyle()
         self.model_id = None
         self._view = None
         self._model = None
 
     @classmethod
-    def from_ase_atoms(cls, atoms, **kwargs):
-        frames = []
+    def from_ase_atoms(cls, atoms, precision='f4', **kwargs):
+        """
+        Create a model from ASE Atoms objects.
+
+        Arguments:
+          atoms (ase.Atoms or list): a single structure or a trajectory
+          precision (str): data type used to store the coordinates; the
+            default single precision ('f4') is sufficient for the three
+            decimals of the PDB format, use 'f8' to keep the coordinates
+            exactly as they are
+          kwargs: further arguments are passed on to the constructor
+
+        """
         if hasattr(atoms, "positions"):
             trajec = [atoms]
         else:
             trajec = atoms
-        for i, frame in enumerate(trajec):
+        raw_frames = []
+        for frame in trajec:
             a, b, c = frame.cell.lengths()
             alpha, beta, gamma = frame.cell.angles()
-            coords = frame.positions
+            coords = frame.positions.astype(precision)
             types = frame.get_chemical_symbols()
-            frames.append(pdb(coords, types, a, b, c, alpha, beta,
-                              gamma, model=(i+1)))
-        return cls(frames, **kwargs)
+            # frames with the same atoms share a single list of symbols
+            if raw_frames and types == raw_frames[-1][1]:
+                types = raw_frames[-1][1]
+            raw_frames.append((coords, types, a, b, c, alpha, beta, gamma))
+        return cls(_LazyFrames(raw_frames), **kwargs)
 
     @classmethod
-    def from_pymatgen_structures(cls, structures, **kwargs):
-        frames = []
+    def from_pymatgen_structures(cls, structures, precision='f4', **kwargs):
+        """
+        Create a model from pymatgen Structure objects.
+
+        Arguments:
+          structures (Structure or list): a single structure or a
+            trajectory
+          precision (str): data type used to store the coordinates, see
+            `from_ase_atoms()`
+          kwargs: further arguments are passed on to the constructor
+
+        """
         if hasattr(structures, "cart_coords"):
             trajec = [structures]
         else:
             trajec = structures
-        for i, frame in enumerate(trajec):
-            coords = frame.cart_coords
+        raw_frames = []
+        for frame in trajec:
+            coords = frame.cart_coords.astype(precision)
             a, b, c, alpha, beta, gamma = frame.lattice.parameters
             types = [s.symbol for s in frame.species]
-            frames.append(pdb(coords, types, a, b, c, alpha, beta,
-                              gamma, model=(i+1)))
-        return cls(frames, **kwargs)
+            if raw_frames and types == raw_frames[-1][1]:
+                types = raw_frames[-1][1]
+            raw_frames.append((coords, types, a, b, c, alpha, beta, gamma))
+        return cls(_LazyFrames(raw_frames), **kwargs)
 
     @classmethod
     def from_file(cls, filename, frmt=None, **kwargs):
         if not ase_loaded:
             raise ValueError("`ase` package not found.")
-        if frmt is not None and frmt not in ase.io.formats.ioformats:
-            raise ValueError("File format not supported: {}".format(frmt))
+        if frmt is not None:
+            _validate_frmt(frmt)
         atoms = ase.io.read(filename=filename, format=frmt, index=":")
         return cls.from_ase_atoms(atoms, **kwargs)
 
@@ -113,6 +296,48 @@ class Model(object):
     def num_frames(self):
         return len(self.frames)
 
+    @property
+    def frames(self):
+        """
+        The frames of the structure model, e.g., one string in PDB format
+        per frame.
+
+        """
+        return self._frames
+
+    @frames.setter
+    def frames(self, frames):
+        if isinstance(frames, _LazyFrames):
+            self._frames = frames
+        else:
+            self._frames = tuple(frames)
+        # the joined frames are cached until the frames are replaced
+        self._joined = None
+        self._payload_version += 1
+        # the style calls depend on the number of frames
+        self._apply_ops = [None]*len(self.representations)
+
+    @property
+    def joined_pdb(self):
+        """
+        All frames joined into a single multi-model string.  The string is
+        only built on first access.
+
+        """
+        if self._joined is None:
+            self._joined = "\n".join(self.frames)
+        return self._joined
+
+    def append_frame(self, frame):
+        """
+        Append a frame to the structure model.
+
+        Arguments:
+          frame (str): the atomic structure in the model's format
+
+        """
+        self.frames = tuple(self.frames) + (frame,)
+
     @property
     def active_frame(self):
         return self._active_frame
@@ -120,11 +345,20 @@ class Model(object):
     @active_frame.setter
     def active_frame(self, frame):
         i = max(-self.num_frames, min(frame, self.num_frames-1))
+        previous = self.frame_index
         self._active_frame = i
-        if self._model is not None:
-            if i < 0:
-                i = self.num_frames + i
-            self._model.setFrame(i)
+        if self._model is not None and self.frame_index != previous:
+            self._model.setFrame(self.frame_index)
+
+    @property
+    def frame_index(self):
+        """
+        Non-negative index of the active frame.
+
+        """
+        if self._active_frame < 0:
+            return self.num_frames + self._active_frame
+        return self._active_frame
 
     def add_representation(self, style, selection=None):
         """
@@ -140,9 +374,10 @@ class Model(object):
         sel = {'model': -1}
         if selection is not None:
             sel.update(selection)
-        if style in atom_styles:
-            style = atom_styles[style]
+        style = atom_styles.get(style, style)
         self.representations.append((sel, style))
+        self._apply_ops.append(None)
+        self._dirty = True
 
     def update_representation(self, style, selection=None, representation=-1):
         """
@@ -161,9 +396,12 @@ class Model(object):
             sel = {'model': -1}
         if selection is not None:
             sel.update(selection)
-        if style in atom_styles:
-            style = atom_styles[style]
+        style = atom_styles.get(style, style)
+        if self.representations[representation] == (sel, style):
+            return
         self.representations[representation] = (sel, style)
+        self._apply_ops[representation] = None
+        self._dirty = True
         self.update()
 
     def add_to_view(self, view, model_id):
@@ -175,20 +413,70 @@ class Model(object):
         """
         self.model_id = model_id
         self._view = view
-        data = "\n".join(self.frames)
-        view.addModelsAsFrames(data, self.frmt)
-        self._model = view.getModel(-1)
-        for sel, style in self.representations:
-            style.apply(self._model, selection=sel)
-        self._model.setFrame(self.active_frame)
+        self._loaded_payload = self._payload()
+        view.addModelsAsFrames(self.joined_pdb, self.frmt)
+        # 3Dmol.js numbers the models in the order they are added.  The
+        # model is looked up by its ID, since getModel(-1) would refer to
+        # the last model at the time later commands are run.
+        self._model = view.getModel(self.model_id)
+        self._apply_styles()
+        self._model.setFrame(self.frame_index)
         if self.show_cell:
             view.addUnitCell({'model': self.model_id}, self.cell_style)
 
+    def _payload(self):
+        """
+        Return the state of the model that determines the data added to a
+        view by `add_to_view()`.
+
+        """
+        return (self._payload_version, self.show_cell,
+                copy.deepcopy(self.cell_style))
+
+    @property
+    def needs_reload(self):
+        """
+        True if the frames or the unit cell have changed since the model
+        was added to a view, so that it has to be added again.
+
+        """
+        return (self._loaded_payload is not None
+                and self._loaded_payload != (self._payload_version,
+                                             self.show_cell,
+                                             self.cell_style))
+
+    def _apply_styles(self):
+        """
+        Apply all representations to the view.  The 3Dmol.js calls of
+        each representation are only constructed once.
+
+        """
+        all_frames = self.num_frames > 1
+        for i, (sel, style) in enumerate(self.representations):
+            if self._apply_ops[i] is None:
+                self._apply_ops[i] = style.apply_ops(sel, all_frames)
+            for method, args in self._apply_ops[i]:
+                getattr(self._model, method)(*args)
+        self._dirty = False
+
+    @property
+    def needs_update(self):
+        """
+        True if the representations have changed since they were last
+        applied to the view.
+
+        """
+        return self._dirty
+
     def update(self):
+        """
+        Re-apply the representations to the view if they have changed and
+        display the active frame.
+
+        """
         if self._model is None:
             raise ValueError(
                 "Model has to be added to a view before it can be updated.")
-        else:
-            for sel, style in self.representations:
-                style.apply(self._model, selection=sel)
-        self._model.setFrame(self.active_frame)
+        elif self._dirty:
+            self._apply_styles()
+        self._model.setFrame(self.frame_index)
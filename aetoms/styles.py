@@ -3,6 +3,8 @@ Visualization styles.
 
 """
 
+from collections import defaultdict
+
 __author__ = "Alexander Urban"
 __email__ = "aurban@atomistic.net"
 __date__ = "2021-01-23"
@@ -59,8 +61,72 @@ DEFAULT_COLORS.update({
     'Ir': 'violet'
 })
 
+# chemical symbols indexed by the atomic number
+ELEM_BY_Z = (
+    'X', 'H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na', 'Mg',
+    'Al', 'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca', 'Sc', 'Ti', 'V', 'Cr', 'Mn',
+    'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr', 'Rb',
+    'Sr', 'Y', 'Zr', 'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd', 'In',
+    'Sn', 'Sb', 'Te', 'I', 'Xe', 'Cs', 'Ba', 'La', 'Ce', 'Pr', 'Nd', 'Pm',
+    'Sm', 'Eu', 'Gd', 'Tb', 'Dy', 'Ho', 'Er', 'Tm', 'Yb', 'Lu', 'Hf', 'Ta',
+    'W', 'Re', 'Os', 'Ir', 'Pt', 'Au', 'Hg', 'Tl', 'Pb', 'Bi', 'Po', 'At',
+    'Rn', 'Fr', 'Ra', 'Ac', 'Th', 'Pa', 'U', 'Np', 'Pu', 'Am', 'Cm', 'Bk',
+    'Cf', 'Es', 'Fm', 'Md', 'No', 'Lr', 'Rf', 'Db', 'Sg', 'Bh', 'Hs', 'Mt',
+    'Ds', 'Rg', 'Cn', 'Nh', 'Fl', 'Mc', 'Lv', 'Ts', 'Og'
+)
+
+
+def _color_groups(colors):
+    """
+    Group species by color.
+
+    Arguments:
+      colors (dict): element specific colors; the 'default' entry is
+        ignored
+
+    Returns:
+      dict mapping each color to the list of species with that color
+
+    """
+    groups = defaultdict(list)
+    for species, color in colors.items():
+        if species != 'default':
+            groups[color].append(species)
+    return dict(groups)
+
+
+def _color_map(colors):
+    """
+    Map chemical symbols to colors for 3Dmol.js' setColorByElement().
+
+    Arguments:
+      colors (dict): element specific colors; if a 'default' color is
+        defined, it is used for all elements without specific color
+
+    Returns:
+      dict mapping chemical symbols to colors
+
+    """
+    if 'default' in colors:
+        cmap = {s: colors['default'] for s in ELEM_BY_Z}
+    else:
+        cmap = {}
+    cmap.update({s: c for s, c in colors.items() if s != 'default'})
+    return cmap
+
+
+# The groups and the color map for the default colors are shared by all
+# styles that use them
+DEFAULT_COLOR_GROUPS = _color_groups(
+    {s: DEFAULT_COLORS[s] for s in ELEM_BY_Z if s in DEFAULT_COLORS})
+DEFAULT_COLOR_MAP = _color_map(DEFAULT_COLORS)
+
 
 class AtomStyle(object):
+
+    __slots__ = ('styles', 'colors', 'style_specs', '_style_cache',
+                 '_grouped_style_cache', '_color_map', '_color_groups')
+
     def __init__(self, style, colors=DEFAULT_COLORS, **style_specs):
         """
         Arguments:
@@ -73,6 +139,10 @@ class AtomStyle(object):
         self.styles = [style]
         self.colors = colors
         self.style_specs = [style_specs]
+        self._style_cache = None
+        self._grouped_style_cache = None
+        self._color_map = None
+        self._color_groups = None
 
     def add_style(self, style, **style_specs):
         """
@@ -86,14 +156,64 @@ class AtomStyle(object):
         """
         self.styles.append(style)
         self.style_specs.append(style_specs)
+        self._style_cache = None
+        self._grouped_style_cache = None
+        self._color_map = None
+        self._color_groups = None
 
-    def apply(self, model, selection=None):
+    def _build_cache(self):
         """
-        Apply style to a structure model.
+        Construct the style dictionaries passed to 3Dmol.js once, so that
+        they do not have to be recreated each time the style is applied.
+
+        """
+        style_dict = {}
+        for style, specs in zip(self.styles, self.style_specs):
+            style_dict[style] = dict(specs)
+        self._style_cache = style_dict
+        # Atom colors can be set with a single call of setColorByElement()
+        # if the style does not define a color itself, which would take
+        # precedence over the atom colors.
+        if any('color' in specs for specs in style_dict.values()):
+            self._color_map = None
+        elif self.colors is DEFAULT_COLORS:
+            self._color_map = DEFAULT_COLOR_MAP
+        else:
+            self._color_map = _color_map(self.colors)
+        # Otherwise, element-specific colors have to be part of the style.
+        default_color = self.colors.get('default')
+        if default_color is not None:
+            self._grouped_style_cache = {
+                style: dict(specs, color=default_color)
+                for style, specs in style_dict.items()}
+        else:
+            self._grouped_style_cache = style_dict
+        # species with the same color can be styled with a single
+        # selection, which saves calls to 3Dmol.js
+        if self.colors is DEFAULT_COLORS:
+            groups = DEFAULT_COLOR_GROUPS
+        else:
+            groups = _color_groups(self.colors)
+        self._color_groups = [
+            (elems, {style: dict(specs, color=color)
+                     for style, specs in style_dict.items()})
+            for color, elems in groups.items()]
+
+    def apply_ops(self, selection=None, all_frames=False):
+        """
+        Return the calls of 3Dmol.js model methods that apply the style.
 
         Arguments:
-          model (3Dmol.js Model): the structure model
           selection (dict): AtomSelectionSpec
+          all_frames (bool): if True, the style is applied to all frames
+            of a multi-frame model.  3Dmol.js' setColorByElement() only
+            colors the atoms of the current frame, so that the colors are
+            then set with one setStyle() call per color instead.
+
+        Returns:
+          list of (method, arguments) tuples with the name of the model
+          method and a tuple of its arguments; the dictionaries are
+          shared and must not be modified
 
         """
         if selection is not None:
@@ -101,44 +221,55 @@ class AtomStyle(object):
         else:
             sel = {}
 
-        if 'default' in self.colors:
-            default_color = self.colors['default']
-        else:
-            default_color = None
+        if self._color_groups is None:
+            self._build_cache()
 
-        style_dict = {}
-        for i, style in enumerate(self.styles):
-            style_dict[style] = self.style_specs[i]
-            if default_color is not None:
-                style_dict[style]['color'] = default_color
+        if self._color_map is not None and not all_frames:
+            return [('setStyle', (sel, self._style_cache)),
+                    ('setColorByElement', (sel, self._color_map))]
 
-        model.setStyle(sel, style_dict)
+        ops = [('setStyle', (sel, self._grouped_style_cache))]
+        # Overwrite default styles with element-specific colors.
+        for elems, species_dict in self._color_groups:
+            ops.append(('setStyle', ({'elem': elems, **sel}, species_dict)))
+        return ops
 
-        # Overwrite default styles with element-specific colors.  Woud
-        # be great to make use of mode.setColorByElement() but I could
-        # not figure out how to use this method from Python.
-        for species in self.colors:
-            if species != 'default':
-                species_dict = style_dict.copy()
-                for style in species_dict:
-                    species_dict[style].update({'color': self.colors[species]})
-                model.setStyle({'elem': species, **sel},
-                               species_dict)
+    def apply(self, model, selection=None, all_frames=False):
+        """
+        Apply style to a structure model.
+
+        Arguments:
+          model (3Dmol.js Model): the structure model
+          selection (dict): AtomSelectionSpec
+          all_frames (bool): style all frames, see `apply_ops()`
+
+        """
+        for method, args in self.apply_ops(selection, all_frames):
+            getattr(model, method)(*args)
 
 
 class StickStyle(AtomStyle):
+
+    __slots__ = ()
+
     def __init__(self, bond_radius=0.1, **kwargs):
         super(StickStyle, self).__init__(
             style='stick', radius=bond_radius, **kwargs)
 
 
 class VanDerWaalsStyle(AtomStyle):
+
+    __slots__ = ()
+
     def __init__(self, sphere_scale=1.0, **kwargs):
         super(VanDerWaalsStyle, self).__init__(
             style='sphere', scale=sphere_scale, **kwargs)
 
 
 class BallAndStickStyle(AtomStyle):
+
+    __slots__ = ()
+
     def __init__(self, sphere_scale=0.4, bond_radius=0.1, **kwargs):
         super(BallAndStickStyle, self).__init__(
             style='sphere', scale=sphere_scale, **kwargs)
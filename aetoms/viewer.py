@@ -3,11 +3,14 @@ Visualize atomic structures using py3Dmol and 3Dmol.js
 
 """
 
+import asyncio
+import time
+
 import py3Dmol
 import IPython
 from ipywidgets import (Button, Layout, IntSlider, Dropdown, Output,
-                        Play, IntText, BoundedIntText,
-                        VBox, HBox, interactive_output, jslink)
+                        ToggleButton, IntText, BoundedIntText,
+                        VBox, HBox)
 
 __author__ = "Alexander Urban"
 __email__ = "aurban@atomistic.net"
@@ -17,6 +20,12 @@ __version__ = "0.1"
 
 class Viewer(object):
 
+    # seconds without further changes of the frame slider or the style
+    # before the view is updated
+    debounce_delay = 0.05
+    # minimum time in seconds between two updates sent from the widgets
+    min_update_interval = 0.05
+
     def __init__(self, model=None, width=600, height=400):
         self.width = width
         self.height = height
@@ -27,9 +36,18 @@ class Viewer(object):
             self.models = []
             self._active_model = None
         self.view = None
+        self._num_models_in_view = 0
+        # frames of each model in the view with hover callbacks
+        self._hover_frames = {}
+        self._pending = {}
+        self._flush_handle = None
+        self._last_flush = None
+        self._ui = None
+        self._widgets = None
 
     def __str__(self):
-        return
+        return "<Viewer models={} active={}>".format(
+            self.num_models, self.active_model)
 
     @property
     def num_models(self):
@@ -43,6 +61,10 @@ class Viewer(object):
     def active_frame(self):
         return self.models[self.active_model].active_frame
 
+    @property
+    def frame_index(self):
+        return self.models[self.active_model].frame_index
+
     @property
     def active_model(self):
         return self._active_model
@@ -66,14 +88,36 @@ class Viewer(object):
     def _set_hoverable(self):
         """
         Set javascript function that is called when hovering over atoms.
-        Only to be called after the 3Dmol view is created with `show()`
-        and needs to be followed by a call to `self.view.update()`.
+        3Dmol.js attaches the callbacks to the atoms of the current frame
+        of each model, where they persist across style changes.  They are
+        therefore installed for each frame the first time it is
+        displayed.  A following `view.update()` is required if the view
+        is already displayed.
+
+        Returns:
+          True if callbacks were installed and False otherwise
 
         """
         if self.view is None:
-            return
+            return False
+        installed = False
+        for i in range(self._num_models_in_view):
+            frames = self._hover_frames.setdefault(i, set())
+            frame = self.models[i].frame_index
+            if frame not in frames:
+                frames.add(frame)
+                self._install_hover_callbacks({'model': i})
+                installed = True
+        return installed
+
+    def _install_hover_callbacks(self, selection):
+        """
+        Arguments:
+          selection (dict): AtomSelectionSpec of the atoms that show labels
+
+        """
         self.view.setHoverable(
-            {}, True,
+            selection, True,
             '''function(atom, viewer, event, container) {
                  if(!atom.label) {
                    atom.label = viewer.addLabel(
@@ -98,44 +142,201 @@ class Viewer(object):
         If called with keyword arguments, those will be passed on to
         `update()`.
 
+        Each call creates a new py3Dmol view, so that only the commands
+        that set up the current state of the models are sent to 3Dmol.js
+        and not the history of all earlier updates.  The PDB strings and
+        style calls of the models are cached and not rebuilt.
+
         """
         self.view = py3Dmol.view(width=self.width, height=self.height)
+        self._hover_frames = {}
         for i, m in enumerate(self.models):
             m.add_to_view(self.view, i)
+        self._num_models_in_view = self.num_models
         self.view.zoomTo()
         self._set_hoverable()
         self.view.show()
         if len(kwargs) > 0:
             self.update(**kwargs)
 
+    def _needs_show(self):
+        """
+        True if `show()` has to be called before the view can be updated,
+        i.e., if there is no view yet, if models have been added that are
+        not yet part of it, or if models in the view need to be reloaded.
+
+        """
+        if self.view is None or self._num_models_in_view < self.num_models:
+            return True
+        return any(m.needs_reload for m in self.models)
+
     def update(self, model=None, frame=None, style=None):
-        if self.view is None:
+        """
+        Update the view with the changes of the model, frame, or style.
+        Only the changes are sent to 3Dmol.js, and nothing is sent if
+        the arguments do not change the displayed structures.
+
+        Arguments:
+          model (int): ID of the model that becomes the active model
+          frame (int): frame of the active model that is displayed
+          style (AtomStyle or str): new style of the active model
+
+        """
+        if self._needs_show():
             self.show()
         if model is not None:
             self.active_model = model
+        active = self.models[self.active_model]
+        changed = False
         if frame is not None:
-            self.models[self.active_model].active_frame = frame
+            # changing the frame only requires a call of setFrame()
+            previous = active.frame_index
+            active.active_frame = frame
+            changed = active.frame_index != previous
         if style is not None:
-            self.models[self.active_model].update_representation(style)
+            previous = active.representations[-1]
+            active.update_representation(style)
+            changed = changed or active.representations[-1] is not previous
         for m in self.models:
+            if m.needs_update:
+                m.update()
+                changed = True
+        if self._set_hoverable():
+            changed = True
+        if changed:
+            self.view.update()
+
+    def play(self, interval=100):
+        """
+        Animate the trajectories with 3Dmol.js.  The animation runs in the
+        browser, so that no frames have to be sent from Python.
+
+        Arguments:
+          interval (int): time between two frames in milliseconds
+
+        """
+        if self._needs_show():
+            self.show()
+        # 3Dmol.js' animate() starts another timer loop instead of
+        # replacing a running one, so that any running animation has to
+        # be stopped first, e.g., when the interval is changed.
+        self.view.stopAnimate()
+        self.view.animate({'loop': 'forward', 'reps': 0,
+                           'interval': interval})
+        self.view.update()
+
+    def stop(self):
+        """
+        Stop the animation started with `play()` and display the active
+        frames again.
+
+        """
+        if self.view is None:
+            return
+        if self._needs_show():
+            # a new view is not animated and displays the active frames
+            self.show()
+            return
+        self.view.stopAnimate()
+        for m in self.models[:self._num_models_in_view]:
             m.update()
-        self._set_hoverable()
         self.view.update()
 
-    def app(self):
+    def _schedule_update(self, delay=0.0, **changes):
+        """
+        Collect changes from the widgets and apply them with a single call
+        of `update()` once the event loop is idle, so that changes that
+        arrive together are sent to 3Dmol.js at once.  Updates are sent at
+        most once every `min_update_interval` seconds; changes arriving in
+        between are merged and applied with the next update.
+
+        Arguments:
+          delay (float): time in seconds without further changes before
+            the update is applied (debouncing)
+          changes: arguments of `update()`
+
+        """
+        self._pending.update(changes)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush_update()
+        else:
+            if self._last_flush is not None:
+                elapsed = time.monotonic() - self._last_flush
+                delay = max(delay, self.min_update_interval - elapsed)
+            self._flush_handle = loop.call_later(delay, self._flush_update)
+
+    def _flush_update(self):
+        """
+        Apply the changes collected by `_schedule_update()`.
+
+        """
+        self._flush_handle = None
+        changes, self._pending = self._pending, {}
+        self._run_script(self.update, **changes)
+        self._last_flush = time.monotonic()
+
+    def _run_script(self, func, *args, **kwargs):
+        """
+        Call a method that sends scripts to the displayed view.  The
+        scripts are displayed in the hidden output area, replacing the
+        previous ones, but exceptions are shown in the visible one.  If
+        the view has to be shown first, it is displayed in the visible
+        output area.
+
+        Arguments:
+          func (callable): the method, e.g., `update()` or `play()`
+          args, kwargs: arguments passed on to `func`
+
+        """
+        if self._needs_show():
+            with self._out:
+                IPython.display.clear_output(wait=True)
+                self.show()
+        error = None
+        with self._script_out:
+            IPython.display.clear_output(wait=True)
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                error = e
+        if error is not None:
+            with self._out:
+                raise error
+
+    def _build_ui(self):
+        """
+        Construct the widgets of the interactive app and connect their
+        callbacks.  This is only done once per viewer; see `app()`.
+
+        """
+        # widgets with the same layout share a single Layout instance
+        auto_width = Layout(width="auto")
+        text_width = Layout(max_width="150px")
+        centered = Layout(align_items='center')
         self._out = Output(layout=Layout(width="{}px".format(self.width+2),
                                          height="{}px".format(self.height+2),
                                          border='1px solid black'))
+        # The scripts that update the view are displayed in a separate,
+        # invisible output area.  The 3Dmol.js canvas in `_out` is thus
+        # modified in place and never cleared, and since the previous
+        # script is replaced by the next one, the scripts do not pile up
+        # in the notebook.
+        self._script_out = Output(layout=Layout(height='0px',
+                                                overflow='hidden'))
         sld_frame = IntSlider(description="Frame",
                               min=0, max=self.num_frames-1,
-                              step=1, value=self.active_frame,
+                              step=1, value=self.frame_index,
+                              continuous_update=False,
                               layout=Layout(width="{}px".format(self.width)))
-        btn_play = Play(description="Animate",
-                        min=0, max=self.num_frames-1,
-                        step=1, value=self.active_frame,
-                        interval=200)
-        btn_fwrd = Button(description="▶▶", layout=Layout(width="auto"))
-        btn_revs = Button(description="◀◀", layout=Layout(width="auto"))
+        btn_play = ToggleButton(description="Animate", icon="play",
+                                layout=auto_width)
+        btn_fwrd = Button(description="▶▶", layout=auto_width)
+        btn_revs = Button(description="◀◀", layout=auto_width)
         drd_model = Dropdown(description="Model",
                              options=list(range(self.num_models)),
                              value=self.active_model)
@@ -144,37 +345,80 @@ class Viewer(object):
                                       'default'],
                              value='default')
         int_delay = IntText(description="Delay (ms)", value=100,
-                            layout=Layout(max_width="150px"))
+                            layout=text_width)
         int_step = BoundedIntText(description="Step", value=1,
                                   min=1, max=self.num_frames,
-                                  layout=Layout(max_width="150px"))
+                                  layout=text_width)
         ui = VBox([HBox([drd_model, drd_style]),
                    self._out,
+                   self._script_out,
                    HBox([VBox([int_step, int_delay]),
                          VBox([sld_frame,
                                HBox([btn_revs, btn_play, btn_fwrd])],
-                              layout=Layout(align_items='center'))])],
-                  layout=Layout(align_items='center'))
+                              layout=centered)])],
+                  layout=centered)
 
         def frame_fwrd(btn):
-            if (sld_frame.value < sld_frame.max):
-                sld_frame.value += 1
+            sld_frame.value = min(sld_frame.value + int_step.value,
+                                  sld_frame.max)
 
         def frame_revs(btn):
-            if (sld_frame.value > sld_frame.min):
-                sld_frame.value -= 1
+            sld_frame.value = max(sld_frame.value - int_step.value,
+                                  sld_frame.min)
 
-        def frame_change(model, frame, style):
-            with self._out:
-                self.update(model=model, frame=frame, style=style)
+        def toggle_play(change):
+            if btn_play.value:
+                self._run_script(self.play, interval=int_delay.value)
+            else:
+                self._run_script(self.stop)
+            btn_play.icon = "stop" if btn_play.value else "play"
+
+        def delay_change(change):
+            if btn_play.value:
+                self._run_script(self.play, interval=change['new'])
 
         btn_fwrd.on_click(frame_fwrd)
         btn_revs.on_click(frame_revs)
-        jslink((btn_play, "value"), (sld_frame, "value"))
-        jslink((int_delay, "value"), (btn_play, "interval"))
-        jslink((int_step, "value"), (btn_play, "step"))
-        interactive_output(frame_change, {'model': drd_model,
-                                          'style': drd_style,
-                                          'frame': sld_frame})
-
-        IPython.display.display(ui)
+        btn_play.observe(toggle_play, names='value')
+        int_delay.observe(delay_change, names='value')
+        drd_model.observe(
+            lambda change: self._schedule_update(model=change['new']),
+            names='value')
+        drd_style.observe(
+            lambda change: self._schedule_update(
+                delay=self.debounce_delay, style=change['new']),
+            names='value')
+        sld_frame.observe(
+            lambda change: self._schedule_update(
+                delay=self.debounce_delay, frame=change['new']),
+            names='value')
+
+        self._widgets = dict(model=drd_model, style=drd_style,
+                             frame=sld_frame, step=int_step)
+        self._ui = ui
+
+    def app(self):
+        """
+        Display an interactive app with widgets to select the model, the
+        style, and the frame.  The widgets are only created on the first
+        call and are displayed again by later calls.
+
+        """
+        if self._ui is None:
+            self._build_ui()
+        w = self._widgets
+        # models may have been added since the widgets were created
+        if len(w['model'].options) != self.num_models:
+            w['model'].options = list(range(self.num_models))
+        w['frame'].max = self.num_frames - 1
+        w['step'].max = self.num_frames
+        IPython.display.display(self._ui)
+        with self._script_out:
+            IPython.display.clear_output()
+        with self._out:
+            IPython.display.clear_output()
+            if self.view is not None:
+                self.show()
+        self._schedule_update(model=w['model'].value,
+                              frame=w['frame'].value,
+                              style=w['style'].value)
@@ -1,4 +1,4 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 from codecs import open
 import os
 
@@ -17,6 +17,17 @@ with open(os.path.join(here, 'README.md'), encoding='utf-8') as fp:
 with open(os.path.join(here, package_name, 'VERSION')) as fp:
     version = fp.read().strip()
 
+# The compiled PDB formatter is optional and only built if Cython is
+# available; otherwise the pure Python implementation is used.
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(
+        [Extension(package_name + '._pdb',
+                   [os.path.join(package_name, '_pdb.pyx')])],
+        language_level=3)
+except ImportError:
+    ext_modules = []
+
 setup(
     name=package_name,
     version=version,
@@ -35,5 +46,6 @@ setup(
     ],
     keywords=['materials science', 'crystal structure', 'visualization'],
     packages=find_packages(exclude=['tests']),
+    ext_modules=ext_modules,
     install_requires=['py3Dmol']
 )